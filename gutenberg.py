@@ -45,19 +45,38 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import os, sys, re, sqlite3, tarfile, json
-import random, urllib, unicodedata, zlib, time, datetime, http.client
-from urllib.request import urlopen
+import os, sys, re, io, sqlite3, tarfile, json, codecs, functools
+import random, urllib.error, urllib.parse, unicodedata, zlib, time, datetime
+import http.client, threading, queue, bz2, socket, signal, base64
+from urllib.request import urlopen, getproxies, proxy_bypass
 from xml.etree import ElementTree
-from multiprocessing import Pool
-from string import ascii_uppercase
-from email.utils import parsedate
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from email.utils import parsedate, format_datetime
+from collections import deque
 
 # Default database path.
 DB_PATH = "~/.gutenberg"
 
-# Default number of worker processes for parallel downloads.
-DOWNLOAD_POOL_SIZE = 4
+# Default number of threads for parallel downloads. Downloads are I/O-bound, so
+# this can be much larger than the number of cores.
+DOWNLOAD_POOL_SIZE = 16
+
+# Number of catalog records handed at once to worker processes when updating
+# the catalog.
+CATALOG_BATCH_SIZE = 1000
+
+# Number of downloaded ebooks written to the database in a single transaction.
+DOWNLOAD_BATCH_SIZE = 100
+
+# Number of search results written to the standard output at once.
+SEARCH_BATCH_SIZE = 256
+
+# Size of the chunks in which ebooks are decompressed when streamed.
+CHUNK_SIZE = 1 << 16
+
+# zlib compression level of ebooks contents. Level 9 is several times slower
+# than the default level, for a few percents gain at best on plain text.
+COMPRESSION_LEVEL = 6
 
 # Where to find the Gutenberg catalog. Must be the address of the bz2 file, not
 # the zip file.
@@ -66,9 +85,26 @@ CATALOG_URL = "http://www.gutenberg.org/cache/epub/feeds/rdf-files.tar.bz2"
 # Where to find the list of Gutenberg mirrors.
 MIRRORS_URL = "https://www.gutenberg.org/MIRRORS.ALL"
 
+# Timeout of HTTP requests, in seconds.
+HTTP_TIMEOUT = 30
+
+# Maximum number of HTTP redirections to follow.
+MAX_REDIRECTS = 5
+
+# User agent sent with HTTP requests. The same as urlopen() sends.
+USER_AGENT = "Python-urllib/%d.%d" % sys.version_info[:2]
+
+# Downloads are spread among this number of mirrors, picking the ones that
+# respond fastest.
+MAX_MIRRORS = 8
+
+# Timeout when measuring how fast mirrors respond, in seconds. Slower mirrors
+# are considered unreachable.
+MIRROR_PROBE_TIMEOUT = 5
+
 # https://stackoverflow.com/questions/295135/turn-a-string-into-a-valid-filename
-import unicodedata
-import re
+SLUG_INVALID_RE = re.compile(r'[^\w\s-]')
+SLUG_SEPARATORS_RE = re.compile(r'[-\s]+')
 
 def slugify(value, allow_unicode=False):
     """
@@ -81,32 +117,57 @@ def slugify(value, allow_unicode=False):
     value = str(value)
     if allow_unicode:
         value = unicodedata.normalize('NFKC', value)
-    else:
+    elif not value.isascii():
         value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore').decode('ascii')
-    value = re.sub(r'[^\w\s-]', '', value.lower())
-    return re.sub(r'[-\s]+', '-', value).strip('-_')
+    value = SLUG_INVALID_RE.sub('', value.lower())
+    return SLUG_SEPARATORS_RE.sub('-', value).strip('-_')
 
-# List of Gutenberg HTTP mirrors.
+# Fetches the list of Gutenberg HTTP mirrors. The list is cached in the
+# database, see Gutenberg.mirrors().
 def gutenberg_mirrors():
-   tbl = getattr(gutenberg_mirrors, "tbl", None)
-   if tbl is None:
-      with urlopen(MIRRORS_URL) as fp:
-         urls = re.findall(r"http://[^ \r\n]+", fp.read().decode("UTF-8"))
-         tbl = [url.rstrip("/") for url in urls]
-         try:
-            # Download limits on this one.
-            tbl.remove('http://www.gutenberg.org/dirs')
-         except ValueError:
-            pass
-      gutenberg_mirrors.tbl = tbl
+   with urlopen(MIRRORS_URL) as fp:
+      urls = re.findall(r"http://[^ \r\n]+", fp.read().decode("UTF-8"))
+      tbl = [url.rstrip("/") for url in urls]
+      try:
+         # Download limits on this one.
+         tbl.remove('http://www.gutenberg.org/dirs')
+      except ValueError:
+         pass
    return tbl
 
+# Returns the time it takes to open a TCP connection to a mirror, or None if it
+# can't be reached.
+def connect_time(url):
+   parts = urllib.parse.urlsplit(url)
+   start = time.perf_counter()
+   try:
+      with socket.create_connection((parts.hostname, parts.port or 80), MIRROR_PROBE_TIMEOUT):
+         return time.perf_counter() - start
+   except OSError:
+      return None
+
+# Sorts mirrors by connection time, fastest first. Unreachable mirrors are
+# dropped, unless none of them can be reached.
+def rank_mirrors(urls):
+   # Behind a proxy, mirrors can't be reached directly, and connecting to the
+   # proxy says nothing about them. Keep the catalog order.
+   if any(find_proxy(urllib.parse.urlsplit(url)) for url in urls):
+      return urls
+   with ThreadPoolExecutor(max(len(urls), 1)) as pool:
+      times = list(pool.map(connect_time, urls))
+   ranked = sorted((t, url) for t, url in zip(times, urls) if t is not None)
+   return [url for _, url in ranked] or urls
+
 SCHEMA = """\
 /* Informations about the state of the database.
  * Possible keys are:
  * - last_catalog_update: last day the Gutenberg catalog was updated. If not
  *   present, the catalog will be updated at startup. The catalog can be
  *   updated with the "update" command.
+ * - mirrors: list of Gutenberg HTTP mirrors, as a JSON array. Mirrors are
+ *   sorted by connection time, fastest first.
+ * - last_mirrors_update: last time the above list was fetched. It is fetched
+ *   again before downloading ebooks if older than one day.
  */
 CREATE TABLE IF NOT EXISTS Infos(
    key TEXT PRIMARY KEY UNIQUE NOT NULL,
@@ -155,20 +216,23 @@ CREATE TABLE IF NOT EXISTS Metadata(
 ) WITHOUT ROWID;
 
 /* Full-text index, for searching the contents of the metadata table.
+ * The rowid of each row is the ebook identifier, which is also indexed in the
+ * "key" column.
  * Before indexing, values associated to a field are normalized to NFKC. Unicode
  * case folding is applied on the resulting strings. In addition, the ligatures
  * "œ" and "æ" are converted to ASCII equivalents, and all Unicode whitespace
- * characters are replaced with SPACE (U+0020).
+ * characters are replaced with SPACE (U+0020). Diacritics are then removed by
+ * the tokenizer.
  * This normalization process must be reproduced on query tokens for manually
  * searching the index.
  */
-CREATE VIRTUAL TABLE IF NOT EXISTS Search USING fts3(
-   key INTEGER PRIMARY KEY UNIQUE NOT NULL,
-   language TEXT,
-   author TEXT,
-   title TEXT,
-   subject TEXT,
-   tokenize=simple
+CREATE VIRTUAL TABLE IF NOT EXISTS Search USING fts5(
+   key,
+   language,
+   author,
+   title,
+   subject,
+   tokenize = "unicode61 remove_diacritics 2"
 );
 
 /* Ebooks contents.
@@ -292,60 +356,82 @@ LEGALESE_END_MARKERS = {
    "SERVICE THAT CHARGES FOR DOWNLOAD",
 }
 
+# str.startswith() tests all prefixes of a tuple in a single call. Only lines
+# found by MARKERS_RE below are tested, so this doesn't need to be any faster.
+TEXT_START_PREFIXES = tuple(TEXT_START_MARKERS)
+TEXT_END_PREFIXES = tuple(TEXT_END_MARKERS)
+LEGALESE_START_PREFIXES = tuple(LEGALESE_START_MARKERS)
+LEGALESE_END_PREFIXES = tuple(LEGALESE_END_MARKERS)
+
+# Matches the line break preceding lines that start with any marker. Only these
+# lines need to be examined, the others are copied in bulk. Starting the pattern
+# with a literal character rather than "^" allows the regex engine to skip
+# quickly to the next line break, which makes the scan about 1.5x faster.
+MARKERS_RE = re.compile("\n(?:%s)" % "|".join(re.escape(marker) for marker in
+   TEXT_START_MARKERS | TEXT_END_MARKERS |
+   LEGALESE_START_MARKERS | LEGALESE_END_MARKERS))
+
 # Fixed mess with os.linesep(). We only use LF.
 def remove_boilerplate(text):
    """Remove lines that are part of the Project Gutenberg header or footer.
    Note: this function is a port of the C++ utility by Johannes Krugel. The
    original version of the code can be found at:
    http://www14.in.tum.de/spp1307/src/strip_headers.cpp
+   Instead of looping over lines, we jump from one marker line to the next and
+   copy the text in-between as a single slice.
    Args:
       text (unicode): The body of the text to clean up.
    Returns:
       unicode: The text with any non-text content removed.
    """
-   lines = text.splitlines()
-
    out = []
    i = 0
-   footer_found = False
+   pos = 0
    ignore_section = False
 
-   for line in lines:
-      reset = False
+   # Prepend a line break so that the first line is matched, too. Offsets in
+   # the padded string of line breaks are offsets in the original string of the
+   # lines that follow them.
+   for match in MARKERS_RE.finditer("\n" + text):
+      start = match.start()
+      # Lines preceding the current one don't contain any marker.
+      if not ignore_section:
+         out.append(text[pos:start])
+         i += text.count("\n", pos, start)
+      pos = text.find("\n", start) + 1 or len(text)
+      line = text[start:pos]
 
       if i <= 600:
-         # Check if the header ends here
-         if any(line.startswith(token) for token in TEXT_START_MARKERS):
-            reset = True
-
-         # If it's the end of the header, delete the output produced so far.
-         # May be done several times, if multiple lines occur indicating the
-         # end of the header
-         if reset:
+         # Check if the header ends here. If so, delete the output produced so
+         # far. May be done several times, if multiple lines occur indicating
+         # the end of the header
+         if line.startswith(TEXT_START_PREFIXES):
             out = []
             continue
 
       if i >= 100:
-         # Check if the footer begins here
-         if any(line.startswith(token) for token in TEXT_END_MARKERS):
-            footer_found = True
-
-         # If it's the beginning of the footer, stop output
-         if footer_found:
+         # Check if the footer begins here. If so, stop output
+         if line.startswith(TEXT_END_PREFIXES):
             break
 
-      if any(line.startswith(token) for token in LEGALESE_START_MARKERS):
+      if line.startswith(LEGALESE_START_PREFIXES):
          ignore_section = True
          continue
-      elif any(line.startswith(token) for token in LEGALESE_END_MARKERS):
+      elif line.startswith(LEGALESE_END_PREFIXES):
          ignore_section = False
          continue
 
       if not ignore_section:
          out.append(line)
          i += 1
+   else:
+      if not ignore_section:
+         out.append(text[pos:])
 
-   return "\n".join(out).strip() + "\n"
+   return "".join(out).strip() + "\n"
+
+# Line boundaries recognized by str.splitlines(), except LF and CRLF.
+LINE_BREAKS = ("\r", "\v", "\f", "\x1c", "\x1d", "\x1e", "\x85", "\u2028", "\u2029")
 
 def cleanup(text):
    # Strip the leading BOM (if there is one).
@@ -353,8 +439,13 @@ def cleanup(text):
       text = text[1:]
    # NFC Normalization
    text = unicodedata.normalize("NFC", text)
-   # Uniformize line breaks
-   text = "\n".join(text.splitlines())
+   # Uniformize line breaks. Most texts only use CRLF or LF, in which case a
+   # plain replace() is much cheaper than splitting the text into lines.
+   lf_text = text.replace("\r\n", "\n")
+   if any(c in lf_text for c in LINE_BREAKS):
+      text = "\n".join(text.splitlines())
+   else:
+      text = lf_text
    return text.strip()
 
 # Were the ElementTree API not broken, we wouldn't have to hardcode this, nor
@@ -368,21 +459,26 @@ NAMESPACES = {
   "cc": "http://web.resource.org/cc/",
 }
 
+# Replaces namespace prefixes with the corresponding URIs:
+#   dcterms:title -> {http://purl.org/dc/terms/}title
+# ElementTree does this on every call when given a namespaces map, which is
+# costly, so we do it once per expression.
+@functools.lru_cache(maxsize=None)
+def qualify(expr):
+   return re.sub(r"(\w+):", lambda match: "{%s}" % NAMESPACES[match.group(1)], expr)
+
 def find_node(root, expr):
-   nodes = root.findall(expr, NAMESPACES)
+   nodes = root.findall(qualify(expr))
    assert len(nodes) == 1
    return nodes[0]
 
 def find_nodes(root, expr):
-   return root.findall(expr, NAMESPACES)
+   return root.findall(qualify(expr))
 
 def find_attrib(node, expr):
-   namespace, name = expr.split(":")
-   expr = "{%s}%s" % (NAMESPACES[namespace], name)
-   for key, value in node.items():
-      if key == expr:
-         return value
-   assert 0
+   value = node.get(qualify(expr))
+   assert value is not None
+   return value
 
 def extract_author(ebook, key):
    authors = []
@@ -413,6 +509,13 @@ def extract_subject(ebook, key):
    nodes = find_nodes(ebook, "dcterms:subject/rdf:Description/rdf:value")
    return [node.text for node in nodes]
 
+# Names of the plain text files of an ebook, see find_versions(). The first
+# group is the ebook key. Using a single regex rather than one per key avoids
+# compiling a new one for each ebook of the catalog.
+VERSION_NAME_RE = re.compile(r"(\d+)(?:-(?:\d|txt|u|body|utf-16|utf-8))?\.txt")
+
+CHARSET_RE = re.compile("text/plain; charset=(.+)")
+
 # There are a few empty files (e.g. 0 and 1070). There are also files that are
 # not available as plain text.
 def find_versions(ebook, key):
@@ -447,15 +550,13 @@ def find_versions(ebook, key):
       # We add a few exceptions to the {key}(-{digit})? format. This doesn't
       # cover all possible cases.
       dir, name = url.rsplit("/")[-2:]
-      if dir.startswith("etext"):
-         pass
-      elif re.match(r"^%d(-(\d|txt|u|body|utf-16|utf-8))?.txt$" % key, name):
-         pass
-      else:
-         continue
+      if not dir.startswith("etext"):
+         match = VERSION_NAME_RE.fullmatch(name)
+         if not match or match.group(1) != str(key):
+            continue
 
       # Encoding
-      encoding = re.match("text/plain; charset=(.+)", mime)
+      encoding = CHARSET_RE.match(mime)
       encoding = encoding and encoding.group(1) or "utf-8"
       # Last modification date, in the format of sqlite's datetime().
       last_mod = find_node(file, "dcterms:modified").text
@@ -473,24 +574,26 @@ def extract_download_infos(ebook, key):
    if not files:
       return None, None, None
 
-   # Most recent files first.
-   files.sort(key=lambda x: x[2], reverse=True)
-
    # When the same file is available in ASCII and LATIN1, etc., the ASCII
    # version is lossy, so we prefer other versions. Likewise, we prefer UTF-8
-   # to LATIN-1 and others.
-   encs = {}
-   for url, enc, last_mod in files:
-      encs.setdefault(enc, []).append((url, last_mod))
-   if len(encs) > 1 and "us-ascii" in encs:
-      del encs["us-ascii"]
-   if "utf-8" in encs:
-      enc = "utf-8"
-      url, last_mod = encs["utf-8"][0]
+   # to LATIN-1 and others. Most ebooks only have one or two plain text files,
+   # so we avoid sorting them when possible.
+   utf8_files = [file for file in files if file[1] == "utf-8"]
+   if len(files) == 1:
+      url, enc, last_mod = files[0]
+   elif utf8_files:
+      url, enc, last_mod = max(utf8_files, key=lambda x: x[2])
    else:
+      # Most recent files first.
+      files.sort(key=lambda x: x[2], reverse=True)
+      encs = {}
+      for url, enc, last_mod in files:
+         encs.setdefault(enc, []).append((url, last_mod))
+      if len(encs) > 1 and "us-ascii" in encs:
+         del encs["us-ascii"]
       enc, vals = encs.popitem()
       url, last_mod = vals[0]
-   
+
    # Keep the constant part of the final URL:
    #   http://www.gutenberg.org/files/11716/11716-8.txt -> 11716-8.txt
    #   http://www.gutenberg.org/dirs/etext96/zncli10.txt -> etext96/zncli10.txt
@@ -561,8 +664,7 @@ else:
 # 3.txt -> https://www.ibiblio.org/pub/docs/books/gutenberg/0/3/3.txt
 # 832.txt -> https://www.ibiblio.org/pub/docs/books/gutenberg/8/3/832/832.txt
 # etext96/zncli10.txt -> https://www.ibiblio.org/pub/docs/books/gutenberg/etext96/zncli10.txt
-def make_book_url(key, name):
-   mirror = random.choice(gutenberg_mirrors())
+def make_book_url(mirror, key, name):
    if name.startswith("etext"):
       return "%s/%s" % (mirror, name)
    if int(key) < 10:
@@ -587,73 +689,335 @@ def get_last_modified(fp):
    ret = datetime.datetime(*ret[:6]) + datetime.timedelta(1)
    return time.strftime("%Y-%m-%d %H:%M:%S", ret.utctimetuple())
 
-def download_ebook_text(url, enc, prev_mod, downloaded):
-   with urlopen(url) as fp:
-      last_mod = get_last_modified(fp)
-      if not downloaded or last_mod >= prev_mod:
-         data = fp.read()
-         # Sloppy editing, as usual.
-         encs = [enc, "utf-8", "iso-8859-1", "windows-1252", "iso-8859-15"]
-         for enc in encs:
-            try:
-               return url, prev_mod, data.decode(enc)
-            except UnicodeDecodeError:
-               pass
-         inform("cannot download '%s' (invalid encoding)" % url)
-   return None, None, None
-
-def download(key, name, encoding, prev_mod, downloaded):
-   url = make_book_url(key, name)
-   url, last_mod, text = download_ebook_text(url, encoding, prev_mod, downloaded)
-   if not url:
-      return
+# Formats the value of an "If-Modified-Since" header, given the modification
+# date of the version we already have. Reverses the slop added above.
+def make_if_modified_since(last_mod):
+   ret = datetime.datetime.strptime(last_mod, "%Y-%m-%d %H:%M:%S") - datetime.timedelta(1)
+   return format_datetime(ret.replace(tzinfo=datetime.timezone.utc), usegmt=True)
+
+# Persistent HTTP connections of each thread, indexed by (scheme, host). We hit
+# the same mirrors again and again, so keeping connections alive saves a TCP
+# (and possibly TLS) handshake per download. Filled lazily.
+HTTP_STATE = threading.local()
+
+# Errors raised when reusing a connection that the server closed while it was
+# idle. Mirrors typically close idle connections after a few seconds.
+STALE_CONNECTION_ERRORS = (ConnectionResetError, BrokenPipeError)
+
+# Returns the parsed URL of the proxy to use for a URL, or None. Proxies are
+# configured as for urlopen(), with the http_proxy, https_proxy and no_proxy
+# environment variables.
+def find_proxy(parts):
+   proxy = getproxies().get(parts.scheme)
+   if not proxy or proxy_bypass(parts.netloc):
+      return None
+   if "://" not in proxy:
+      proxy = "http://%s" % proxy
+   return urllib.parse.urlsplit(proxy)
+
+# Headers to send to a proxy, if it requires authentication.
+def proxy_headers(proxy):
+   if proxy.username is None:
+      return {}
+   credentials = "%s:%s" % (urllib.parse.unquote(proxy.username),
+                            urllib.parse.unquote(proxy.password or ""))
+   return {"Proxy-Authorization": "Basic %s" % base64.b64encode(credentials.encode()).decode("ascii")}
+
+# Opens a connection to the host of a URL, or to a proxy. HTTPS requests are
+# tunneled through the proxy.
+def http_connect(parts, proxy):
+   if proxy is None:
+      if parts.scheme == "https":
+         return http.client.HTTPSConnection(parts.netloc, timeout=HTTP_TIMEOUT)
+      return http.client.HTTPConnection(parts.netloc, timeout=HTTP_TIMEOUT)
+   proxy_netloc = proxy.netloc.rpartition("@")[2]
+   if parts.scheme == "https":
+      conn = http.client.HTTPSConnection(proxy_netloc, timeout=HTTP_TIMEOUT)
+      conn.set_tunnel(parts.netloc, headers=proxy_headers(proxy))
+      return conn
+   return http.client.HTTPConnection(proxy_netloc, timeout=HTTP_TIMEOUT)
+
+# Performs a request on the persistent connection to the host of a URL. Returns
+# the response and its body.
+def http_request(connections, url, headers):
+   parts = urllib.parse.urlsplit(url)
+   if parts.scheme not in ("http", "https"):
+      raise urllib.error.URLError("unsupported URL scheme: '%s'" % url)
+   headers = {"User-Agent": USER_AGENT, **headers}
+   proxy = find_proxy(parts)
+   if proxy and parts.scheme == "http":
+      # Plain HTTP requests are sent to the proxy with the full URL.
+      path = urllib.parse.urlunsplit(parts._replace(fragment=""))
+      headers.update(proxy_headers(proxy))
+   else:
+      path = parts.path or "/"
+      if parts.query:
+         path = "%s?%s" % (path, parts.query)
+   host = (parts.scheme, parts.netloc, proxy)
+   conn = connections.get(host)
+   reused = conn is not None
+   while True:
+      if conn is None:
+         conn = connections[host] = http_connect(parts, proxy)
+      resp = None
+      try:
+         conn.request("GET", path, headers=headers)
+         resp = conn.getresponse()
+         # Must read the whole body before reusing the connection.
+         return resp, resp.read()
+      except (OSError, http.client.HTTPException) as e:
+         # Start afresh next time.
+         conn.close()
+         del connections[host]
+         # If the server closed a kept-alive connection before answering, try
+         # again once on a new connection, this is not a real failure.
+         # RemoteDisconnected is a subclass of ConnectionResetError.
+         if not (reused and resp is None and isinstance(e, STALE_CONNECTION_ERRORS)):
+            raise
+         conn = None
+         reused = False
+
+def http_get(url, headers={}):
+   """Performs a GET request on a persistent connection, following
+   redirections. Returns the response and its body. Raises HTTPError if the
+   server returns an error status.
+   """
+   connections = getattr(HTTP_STATE, "connections", None)
+   if connections is None:
+      connections = HTTP_STATE.connections = {}
+   for _ in range(MAX_REDIRECTS + 1):
+      resp, body = http_request(connections, url, headers)
+      location = resp.getheader("location")
+      if resp.status in (301, 302, 303, 307, 308) and location:
+         url = urllib.parse.urljoin(url, location)
+         continue
+      if resp.status >= 400:
+         raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, None)
+      return resp, body
+   raise urllib.error.URLError("too many redirections: '%s'" % url)
+
+# Returns the raw contents of an ebook, or None if we already have its last
+# version.
+def download_ebook_data(url, prev_mod, downloaded):
+   headers = {}
+   if downloaded:
+      # Let the server tell us the file is not newer, so that we don't
+      # download it for nothing.
+      headers["If-Modified-Since"] = make_if_modified_since(prev_mod)
+   resp, data = http_get(url, headers)
+   if resp.status == 304:
+      return None
+   # Servers are free to ignore the above header.
+   last_mod = get_last_modified(resp)
+   if not downloaded or last_mod >= prev_mod:
+      return data
+   return None
+
+def decode_ebook_text(data, enc):
+   # Sloppy editing, as usual. If the declared encoding doesn't work, try UTF-8
+   # (only once, each attempt scans the whole text). ISO-8859-1 maps every byte
+   # to a code point, so it never fails, and there is no point trying other
+   # encodings after it.
+   for enc in dict.fromkeys([enc.lower(), "utf-8"]):
+      try:
+         return data.decode(enc)
+      except (UnicodeDecodeError, LookupError):
+         pass
+   return data.decode("iso-8859-1")
+
+# Runs in a worker process, since this is CPU-bound.
+def prepare_ebook(key, url, data, encoding, last_mod):
+   text = decode_ebook_text(data, encoding)
    text = remove_boilerplate(cleanup(text))
-   text = zlib.compress(text.encode("UTF-8"), 9)
+   text = zlib.compress(text.encode("UTF-8"), COMPRESSION_LEVEL)
    return key, text, url, last_mod
 
+# Decompresses a zlib blob. Yields chunks of at most CHUNK_SIZE bytes, so that
+# the whole uncompressed data doesn't need to be held in memory.
+def decompress_chunks(blob):
+   d = zlib.decompressobj()
+   while blob:
+      yield d.decompress(blob, CHUNK_SIZE)
+      blob = d.unconsumed_tail
+   yield d.flush()
+
 MAX_RETRY = 3
 
-def try_download(args):
+# Runs in a download thread.
+def try_download(args, mirrors, workers):
    key, name, encoding, last_modified, downloaded = args
    tries = 0
    while True:
+      # Ebooks are spread evenly among mirrors. A failed download is retried
+      # on the next mirror.
+      mirror = mirrors[(key + tries) % len(mirrors)]
+      url = make_book_url(mirror, key, name)
       try:
-         return download(key, name, encoding, last_modified, downloaded)
-      except KeyboardInterrupt:
-         die()
-      except (urllib.error.URLError, urllib.error.HTTPError, http.client.RemoteDisconnected):
+         data = download_ebook_data(url, last_modified, downloaded)
+         break
+      except (OSError, http.client.HTTPException):
          if tries >= MAX_RETRY:
             inform("cannot download '%s': connection error" % key)
             return
          tries += 1
+   if data is None:
+      return
+   return workers.submit(prepare_ebook, key, url, data, encoding, last_modified).result()
 
 LIGATURES_TBL = str.maketrans({
    "œ": "oe",
    "æ": "ae",
 })
 
-def normalize(s):
+NON_ASCII_RE = re.compile(r"[^\x00-\x7f]+")
+
+# Normalizes a field value before indexing it.
+def normalize_index(s):
    s = unicodedata.normalize("NFKC", s)
    # SQLite doesn't recognize non-ASCII whitespace.
    s = " ".join(s.split())
+   # SQLite doesn't support Unicode casefolding, but does casefold ASCII, so we
+   # only need to bother with non-ASCII strings. Since there are no operators
+   # in field values, these can be casefolded as a whole.
+   if not s.isascii():
+      s = s.casefold()
+      if "œ" in s or "æ" in s:
+         s = s.translate(LIGATURES_TBL)
+   return s
+
+# Normalizes a query. Must produce the same tokens as normalize_index().
+def normalize_query(s):
+   s = unicodedata.normalize("NFKC", s)
+   s = " ".join(s.split())
    # SQLite doesn't support Unicode casefolding. In the context of a query, we
    # can't just casefold the whole string, because the case of query operators
    # is significant. Query operators being ASCII strings, and SQLite being able
    # to casefold ASCII strings, we only bother to casefold non-ASCII code
-   # points.
-   s = "".join(c in ascii_uppercase and c or c.casefold() for c in s)
-   # Ligatures not covered by NFKC.
-   s = s.translate(LIGATURES_TBL)
+   # points. Non-ASCII characters being rare, we casefold whole runs of them
+   # instead of looping over characters.
+   if not s.isascii():
+      s = NON_ASCII_RE.sub(lambda match: match.group().casefold(), s)
+      # Ligatures not covered by NFKC. Few strings contain any, and checking
+      # for them is cheaper than translating.
+      if "œ" in s or "æ" in s:
+         s = s.translate(LIGATURES_TBL)
    return s
 
+# Tokens of a full-text query: phrases, parentheses and barewords.
+QUERY_TOKEN_RE = re.compile(r'"[^"]*"|[()]|[^\s()"]+')
+
+# Barewords that FTS5 accepts as is, with an optional column filter and prefix
+# marker. A column filter can also be followed by a parenthesized expression.
+BAREWORD_RE = re.compile(r"(?:\w+:)?(?:\w+\*?)?$")
+
+# FTS3 splits barewords on punctuation, while FTS5 rejects punctuation outside of
+# phrases. Converts a query written for FTS3 to one that FTS5 accepts and that
+# matches the same ebooks: "saint-exupery" -> '"saint exupery"', "dickens," ->
+# "dickens".
+def upgrade_query(query):
+   tokens = []
+   for token in QUERY_TOKEN_RE.findall(query):
+      if token.startswith('"') or token in "()" or BAREWORD_RE.match(token):
+         tokens.append(token)
+         continue
+      column, _, term = token.rpartition(":")
+      if column and not re.fullmatch(r"\w+", column):
+         term = token
+         column = ""
+      words = re.findall(r"\w+", term)
+      if not words:
+         continue
+      term = '"%s"' % " ".join(words)
+      if token.endswith("*"):
+         term += "*"
+      tokens.append(column and "%s:%s" % (column, term) or term)
+   return " ".join(tokens)
+
 def make_document(fields):
    doc = {}
    for field, values in fields.items():
       if isinstance(values, (str, int)):
          values = [str(values)]
-      doc[field] = " ".join(normalize(value) for value in values)
+      doc[field] = " ".join(normalize_index(value) for value in values)
    return doc
 
+# Number of decompressed chunks that can be waiting to be read from the catalog.
+CATALOG_QUEUE_SIZE = 16
+
+# File-like object that reads and decompresses a bz2 stream in a background
+# thread, so that the network and decompression don't stall the reader. The
+# bz2 module releases the GIL while decompressing.
+class BZ2Prefetcher(io.RawIOBase):
+
+   def __init__(self, fp):
+      self.queue = queue.Queue(CATALOG_QUEUE_SIZE)
+      self.buf = memoryview(b"")
+      self.eof = False
+      self.stopping = False
+      self.thread = threading.Thread(target=self.run, args=(fp,), daemon=True)
+      self.thread.start()
+
+   def put(self, item):
+      if not self.stopping:
+         self.queue.put(item)
+
+   def run(self, fp):
+      try:
+         d = bz2.BZ2Decompressor()
+         for chunk in iter(lambda: fp.read(CHUNK_SIZE), b""):
+            # Concatenated streams are possible.
+            while chunk and not self.stopping:
+               if d.eof:
+                  d = bz2.BZ2Decompressor()
+               try:
+                  data = d.decompress(chunk)
+               except OSError as e:
+                  raise tarfile.ReadError("invalid compressed data") from e
+               if data:
+                  self.put(data)
+               chunk = d.unused_data if d.eof else b""
+            if self.stopping:
+               return
+         if not d.eof:
+            raise tarfile.ReadError("unexpected end of data")
+         self.put(b"")
+      except Exception as e:
+         self.put(e)
+      finally:
+         fp.close()
+
+   def readable(self):
+      return True
+
+   def readinto(self, b):
+      while not self.buf:
+         if self.eof:
+            return 0
+         item = self.queue.get()
+         if isinstance(item, Exception):
+            self.eof = True
+            raise item
+         if not item:
+            self.eof = True
+            return 0
+         self.buf = memoryview(item)
+      n = min(len(b), len(self.buf))
+      b[:n] = self.buf[:n]
+      self.buf = self.buf[n:]
+      return n
+
+   def close(self):
+      if not self.closed:
+         # Unblock the background thread if it is waiting for room in the
+         # queue. It checks the stop flag before queueing anything else.
+         self.stopping = True
+         while True:
+            try:
+               self.queue.get_nowait()
+            except queue.Empty:
+               break
+      super().close()
+
 def iter_catalog(url):
    try:
       fp = urlopen(url)
@@ -665,19 +1029,82 @@ def iter_catalog(url):
       if e.getcode() == 403:
          die("downloads blocked, retry tomorrow")
       raise
+   with io.BufferedReader(BZ2Prefetcher(fp), CHUNK_SIZE) as fp:
+      try:
+         tf = tarfile.open(mode="r|", fileobj=fp)
+      except tarfile.ReadError:
+         # Most likely issue.
+         die("cannot read catalog; too much downloads?")
+      while True:
+         tinfo = tf.next()
+         if not tinfo:
+            break
+         key = os.path.basename(os.path.dirname(tinfo.name))
+         if key.isdigit():
+            yield int(key), tf.extractfile(tinfo).read()
+
+# json.dumps() creates a new encoder at each call when given options, so we use
+# a single one.
+JSON_ENCODER = json.JSONEncoder(ensure_ascii=False)
+
+# Parses a catalog record in a worker process. Returns the rows to insert in
+# the Metadata and Search tables, or None if the ebook is not available as
+# plain text.
+def parse_record(args):
+   key, data = args
+   name, enc, last_mod, fields = parse_xml(io.BytesIO(data), key)
+   if name is None:
+      return None
+   fields["key"] = key
+   metadata = (key, JSON_ENCODER.encode(fields), name, enc, last_mod)
+   doc = make_document(fields)
+   doc["rowid"] = key
+   return metadata, doc
+
+def iter_batches(itor, size):
+   batch = []
+   for item in itor:
+      batch.append(item)
+      if len(batch) == size:
+         yield batch
+         batch = []
+   if batch:
+      yield batch
+
+# Iterates over an iterable in a background thread, so that producing items
+# overlaps with consuming them. At most "size" items are produced in advance.
+# Exceptions raised by the producer are raised again in the consumer.
+def prefetch(itor, size):
+   q = queue.Queue(size)
+   stopping = False
+
+   def run():
+      try:
+         for item in itor:
+            if stopping:
+               return
+            q.put((item, None))
+         q.put((None, StopIteration()))
+      except BaseException as e:
+         q.put((None, e))
+
+   threading.Thread(target=run, daemon=True).start()
    try:
-      tf = tarfile.open(mode="r|bz2", fileobj=fp)
-   except tarfile.ReadError:
-      # Most likely issue.
-      die("cannot read catalog; too much downloads?")
-   while True:
-      tinfo = tf.next()
-      if not tinfo:
-         break
-      key = os.path.basename(os.path.dirname(tinfo.name))
-      if key.isdigit():
-         yield int(key), tf.extractfile(tinfo)
-
+      while True:
+         item, exc = q.get()
+         if isinstance(exc, StopIteration):
+            return
+         if exc:
+            raise exc
+         yield item
+   finally:
+      # Unblock the producer if it is waiting for room in the queue.
+      stopping = True
+      while True:
+         try:
+            q.get_nowait()
+         except queue.Empty:
+            break
 
 class Gutenberg(object):
 
@@ -686,49 +1113,207 @@ class Gutenberg(object):
       self.path = os.path.expandvars(os.path.expanduser(path))
       self.catalog_url = catalog_url
       self.num_workers = num_workers
+      # Download threads and worker processes, created when first needed and
+      # kept until close() is called.
+      self.threads = None
+      self.workers = None
       self.conn = sqlite3.connect(self.path)
       cur = self.conn.cursor()
+      # With a write-ahead log and synchronous=NORMAL, commits don't wait for
+      # the disk, which speeds up bulk inserts considerably. The database can't
+      # be corrupted by a crash, only the last transactions lost. Memory-mapped
+      # I/O saves a copy when reading ebooks contents.
+      cur.executescript("""
+      PRAGMA journal_mode = WAL;
+      PRAGMA synchronous = NORMAL;
+      PRAGMA temp_store = MEMORY;
+      PRAGMA cache_size = -262144;
+      PRAGMA mmap_size = 268435456;
+      """)
       cur.executescript(SCHEMA)
+      self.upgrade_search()
       if not cur.execute("SELECT value FROM Infos WHERE key = 'last_catalog_update'").fetchone():
          self.update_catalog()
 
-   def update_catalog(self):
-      inform("updating catalog")
+   def __enter__(self):
+      return self
+
+   def __exit__(self, *exc_info):
+      self.close()
+
+   def close(self):
+      if self.threads:
+         self.threads.shutdown(cancel_futures=True)
+         self.workers.shutdown(cancel_futures=True)
+         self.threads = self.workers = None
+      self.conn.close()
+
+   def executors(self):
+      if not self.threads:
+         # Start the worker processes now, from the calling thread: forking a
+         # multi-threaded process can deadlock the child, and worker processes
+         # would otherwise be forked from a download thread while others are
+         # running. With the fork start method, all worker processes are
+         # started when the first task is submitted.
+         self.workers = ProcessPoolExecutor()
+         self.workers.submit(int).result()
+         self.threads = ThreadPoolExecutor(self.num_workers)
+      return self.threads, self.workers
+
+   # Databases created by previous versions use FTS3 for the full-text index.
+   # Rebuild it from the metadata table, no need to download the catalog again.
+   # The index is also rebuilt if a previous upgrade was interrupted.
+   def upgrade_search(self):
       cur = self.conn.cursor()
-      cur.executescript("DELETE FROM Metadata; DELETE FROM Search;")
-      for key, fp in iter_catalog(self.catalog_url):
-         name, enc, last_mod, fields = parse_xml(fp, key)
-         if name is None:
-            continue
-         fields["key"] = key
-         cur.execute("""INSERT INTO Metadata(
-            key, metadata, name, encoding, last_modified
-         ) VALUES(?, ?, ?, ?, ?)""",
-         (key, json.dumps(fields, ensure_ascii=False), name, enc, last_mod))
-         doc = make_document(fields)
-         cur.execute("""INSERT INTO SEARCH(
-            key, language, author, title, subject
-         ) VALUES(:key, :language, :author, :title, :subject)""", doc)
+      (sql,) = cur.execute("SELECT sql FROM sqlite_master WHERE name = 'Search'").fetchone()
+      if "fts3" not in sql and (cur.execute("SELECT 1 FROM Search LIMIT 1").fetchone()
+                                or not cur.execute("SELECT 1 FROM Metadata LIMIT 1").fetchone()):
+         return
+      inform("upgrading search index")
+      # DDL statements are committed right away unless a transaction is opened
+      # explicitly, and executescript() commits, so that the index would be
+      # left empty if the rebuild fails.
+      try:
+         cur.execute("BEGIN")
+         cur.execute("DROP TABLE Search")
+         for statement in SCHEMA.split(";\n"):
+            if statement.strip():
+               cur.execute(statement)
+         docs = []
+         for (metadata,) in cur.execute("SELECT metadata FROM Metadata").fetchall():
+            fields = json.loads(metadata)
+            doc = make_document(fields)
+            doc["rowid"] = fields["key"]
+            docs.append(doc)
+         self.index_documents(cur, docs)
+         cur.execute("INSERT INTO Search(Search) VALUES('optimize')")
+         # Stored download queries must still be usable.
+         for query, last_issued in cur.execute("SELECT query, last_issued FROM DownloadQueries").fetchall():
+            if self.valid_query(query):
+               continue
+            new_query = upgrade_query(query)
+            if new_query and self.valid_query(new_query):
+               cur.execute("DELETE FROM DownloadQueries WHERE query = ?", (query,))
+               cur.execute("""INSERT OR REPLACE INTO DownloadQueries(query, last_issued)
+                  VALUES (?, ?)""", (new_query, last_issued))
+         self.conn.commit()
+      except BaseException:
+         self.conn.rollback()
+         raise
+
+   def valid_query(self, query):
+      try:
+         self.conn.execute("SELECT rowid FROM Search WHERE Search MATCH ? LIMIT 1", (query,))
+         return True
+      except sqlite3.OperationalError:
+         return False
+
+   # Normalizes a full-text query and checks that it is valid. Queries written
+   # for FTS3 may contain punctuation outside of phrases, which FTS5 rejects.
+   # These are rewritten to match the same ebooks as before.
+   def parse_query(self, query):
+      query = normalize_query(str(query))
+      try:
+         self.conn.execute("SELECT rowid FROM Search WHERE Search MATCH ? LIMIT 1", (query,))
+      except sqlite3.OperationalError as e:
+         new_query = upgrade_query(query)
+         if not (new_query and self.valid_query(new_query)):
+            die("invalid query: '%s' (%s)" % (query, e))
+         query = new_query
+      return query
+
+   def mirrors(self):
+      cur = self.conn.cursor()
+      if cur.execute("""SELECT datetime('now', '-1 day') < datetime(value)
+         FROM Infos WHERE key = 'last_mirrors_update'""").fetchone() == (1,):
+         (tbl,) = cur.execute("SELECT value FROM Infos WHERE key = 'mirrors'").fetchone()
+         return json.loads(tbl)
+      tbl = rank_mirrors(gutenberg_mirrors())
       cur.execute("""INSERT OR REPLACE INTO Infos(key, value)
-         VALUES('last_catalog_update', datetime('now'))""")
+         VALUES('mirrors', ?)""", (json.dumps(tbl),))
+      cur.execute("""INSERT OR REPLACE INTO Infos(key, value)
+         VALUES('last_mirrors_update', datetime('now'))""")
       self.conn.commit()
+      return tbl
+
+   def update_catalog(self):
+      inform("updating catalog")
+      cur = self.conn.cursor()
+      # The catalog is replaced in a single transaction, so that the previous
+      # one is kept if the update fails. executescript() would commit the
+      # deletions right away.
+      try:
+         cur.execute("DELETE FROM Metadata")
+         cur.execute("DELETE FROM Search")
+         # XML parsing is CPU-bound, so it is done in parallel, by the same
+         # worker processes as downloads. Records are read from the catalog in
+         # a separate thread, while the previous batch is being parsed and
+         # inserted.
+         _, workers = self.executors()
+         batches = iter_batches(iter_catalog(self.catalog_url), CATALOG_BATCH_SIZE)
+         pending = None
+         for batch in prefetch(batches, 2):
+            result = workers.map(parse_record, batch, chunksize=64)
+            if pending:
+               self.insert_records(cur, pending)
+            pending = result
+         if pending:
+            self.insert_records(cur, pending)
+         # Merge the index segments created by successive inserts.
+         cur.execute("INSERT INTO Search(Search) VALUES('optimize')")
+         cur.execute("""INSERT OR REPLACE INTO Infos(key, value)
+            VALUES('last_catalog_update', datetime('now'))""")
+         self.conn.commit()
+      except BaseException:
+         self.conn.rollback()
+         raise
+
+   def insert_records(self, cur, records):
+      records = [record for record in records if record]
+      cur.executemany("""INSERT INTO Metadata(
+         key, metadata, name, encoding, last_modified
+      ) VALUES(?, ?, ?, ?, ?)""", (metadata for metadata, _ in records))
+      self.index_documents(cur, (doc for _, doc in records))
+
+   def index_documents(self, cur, docs):
+      cur.executemany("""INSERT INTO Search(
+         rowid, key, language, author, title, subject
+      ) VALUES(:rowid, :key, :language, :author, :title, :subject)""", docs)
 
    def search(self, query):
-      query = normalize(str(query)) 
-      for (metadata,) in self.conn.execute("""SELECT metadata
-         FROM Metadata NATURAL JOIN Search WHERE Search match ?""", (query,)):
+      query = self.parse_query(query)
+      for (metadata,) in self.conn.execute("""SELECT metadata FROM Metadata
+         WHERE key IN (SELECT rowid FROM Search WHERE Search MATCH ?)""", (query,)):
          yield json.loads(metadata)
    
    def text(self, query):
-      query = normalize(str(query))      
-      for (blob,) in self.conn.execute("""SELECT contents
-         FROM Data NATURAL JOIN Search WHERE Search match ?""", (query,)):      
+      query = self.parse_query(query)
+      for (blob,) in self.conn.execute("""SELECT contents FROM Data
+         WHERE key IN (SELECT rowid FROM Search WHERE Search MATCH ?)""", (query,)):
          yield zlib.decompress(blob).decode()
 
+   def stream(self, query):
+      """Like text(), but yields the contents of all matching ebooks as a
+      sequence of chunks. Large ebooks are never decompressed at once."""
+      for blob in self.contents(query):
+         decoder = codecs.getincrementaldecoder("UTF-8")()
+         for chunk in decompress_chunks(blob):
+            yield decoder.decode(chunk)
+         yield decoder.decode(b"", True)
+
+   def contents(self, query):
+      """Yields the contents of all matching ebooks, as stored in the
+      database, i.e. compressed with zlib."""
+      query = self.parse_query(query)
+      for (blob,) in self.conn.execute("""SELECT contents FROM Data
+         WHERE key IN (SELECT rowid FROM Search WHERE Search MATCH ?)""", (query,)):
+         yield blob
+
    def file(self, query):
-      query = normalize(str(query))
+      query = self.parse_query(query)
       for (author, title, blob) in self.conn.execute("""SELECT author, title, contents
-         FROM Data NATURAL JOIN Search WHERE Search match ?""", (query,)):
+         FROM Search INNER JOIN Data ON Search.rowid = Data.key
+         WHERE Search MATCH ?""", (query,)):
          yield author, title, blob
 
    def queries(self):
@@ -737,26 +1322,28 @@ class Gutenberg(object):
          yield q
    
    def forget(self, query):
-      query = normalize(str(query))
-      self.conn.execute("DELETE FROM DownloadQueries WHERE query = ?", (query,))
+      query = normalize_query(str(query))
+      cur = self.conn.execute("DELETE FROM DownloadQueries WHERE query = ?", (query,))
+      if not cur.rowcount:
+         # Maybe the query was stored as rewritten by parse_query().
+         self.conn.execute("DELETE FROM DownloadQueries WHERE query = ?", (upgrade_query(query),))
       self.conn.commit()
 
    def download(self, query):
-      query = normalize(str(query))
-      cur = self.conn.cursor()
-      cur.execute("""
-      INSERT OR REPLACE INTO DownloadQueries(query, last_issued)
-         VALUES (?, datetime('now'))""", (query,))
-      self.conn.commit()
-      keys = list(cur.execute("""
+      query = self.parse_query(query)
+      keys = list(self.conn.execute("""
       SELECT Metadata.key, Metadata.name,
              Metadata.encoding, Metadata.last_modified,
              Data.when_downloaded
-      FROM Search INNER JOIN Metadata ON Search.key = Metadata.key
+      FROM Search INNER JOIN Metadata ON Search.rowid = Metadata.key
                   LEFT OUTER JOIN Data ON Metadata.key = Data.key
       WHERE Search MATCH ?
             AND Metadata.last_modified > COALESCE(Data.last_modified, '')
       """, (query,)))
+      self.conn.execute("""
+      INSERT OR REPLACE INTO DownloadQueries(query, last_issued)
+         VALUES (?, datetime('now'))""", (query,))
+      self.conn.commit()
       if keys:
          self.download_keys(keys)
 
@@ -766,90 +1353,180 @@ class Gutenberg(object):
       if cur.execute("""SELECT datetime('now', '-1 day') > datetime(value)
          FROM Infos WHERE key = 'last_catalog_update'""").fetchone()[0]:
          self.update_catalog()
-      # We download new files first, then update the ones we've already
-      # downloaded.
-      keys = list(cur.execute("""
-      SELECT Metadata.key, Metadata.name,
-             Metadata.encoding, Metadata.last_modified,
-             COALESCE(Data.when_downloaded, '') AS downloaded
-      FROM Search INNER JOIN Metadata ON Search.key = Metadata.key
-                  INNER JOIN DownloadQueries
-                  LEFT OUTER JOIN Data ON Metadata.key = Data.key
-      WHERE Search MATCH query
-            AND Metadata.last_modified > COALESCE(Data.last_modified, '')
-      UNION
+      # Queries are run one at a time, so that an invalid one doesn't prevent
+      # the others from being updated.
+      rows = {}
+      for (query,) in cur.execute("SELECT query FROM DownloadQueries").fetchall():
+         try:
+            for row in cur.execute("""
+            SELECT Metadata.key, Metadata.name,
+                   Metadata.encoding, Metadata.last_modified,
+                   COALESCE(Data.when_downloaded, '') AS downloaded
+            FROM Search INNER JOIN Metadata ON Search.rowid = Metadata.key
+                        LEFT OUTER JOIN Data ON Metadata.key = Data.key
+            WHERE Search MATCH ?
+                  AND Metadata.last_modified > COALESCE(Data.last_modified, '')
+            """, (query,)):
+               rows[row[0]] = row
+         except sqlite3.OperationalError as e:
+            inform("skipping invalid query: '%s' (%s)" % (query, e))
+      for row in cur.execute("""
       SELECT Metadata.key, Metadata.name,
              Metadata.encoding, Metadata.last_modified,
              Data.when_downloaded AS downloaded
       FROM Metadata INNER JOIN Data ON Metadata.key = Data.key
-      WHERE Metadata.last_modified > Data.last_modified
-      ORDER BY downloaded"""))
+      WHERE Metadata.last_modified > Data.last_modified"""):
+         rows[row[0]] = row
+      # We download new files first, then update the ones we've already
+      # downloaded.
+      keys = sorted(rows.values(), key=lambda row: row[4])
       if keys:
          self.download_keys(keys)
    
    def download_keys(self, keys):
-      p = Pool(self.num_workers)
-      itor = p.imap_unordered(try_download, keys)
-      cur = self.conn.cursor()
-      nr = 0
+      # Threads download ebooks, then hand them to worker processes for
+      # normalization and compression.
+      # Shuffle mirrors so that the same ebooks don't always go to the same
+      # mirrors.
+      mirrors = self.mirrors()[:MAX_MIRRORS]
+      mirrors = random.sample(mirrors, len(mirrors))
+      threads, workers = self.executors()
+      futures = []
+      rows = []
       try:
-         for i, data in enumerate(itor, 1):
+         for args in keys:
+            futures.append(threads.submit(try_download, args, mirrors, workers))
+         for i, future in enumerate(as_completed(futures), 1):
+            data = future.result()
             if data:
-               cur.execute("""INSERT OR REPLACE
-               INTO Data(key, contents, url, last_modified, when_downloaded)
-               VALUES(?, ?, ?, ?, datetime('now'))""", data)
-               nr += 1
-               if nr % 10 == 0:
-                  self.conn.commit()
+               rows.append(data)
+               if len(rows) == DOWNLOAD_BATCH_SIZE:
+                  self.insert_ebooks(rows)
+                  rows = []
             progress(i, len(keys), self.num_workers)
-         self.conn.commit()
+         self.insert_ebooks(rows)
       finally:
+         # Don't leave pending downloads behind if we're interrupted.
+         for future in futures:
+            future.cancel()
          progress_finish()
 
+   # Ebooks are downloaded by other threads in the meantime, so writing them
+   # doesn't delay downloads.
+   def insert_ebooks(self, rows):
+      self.conn.executemany("""INSERT OR REPLACE
+         INTO Data(key, contents, url, last_modified, when_downloaded)
+         VALUES(?, ?, ?, ?, datetime('now'))""", rows)
+      self.conn.commit()
+
+# Instance shared by all commands, created when first needed.
+GUTENBERG = None
+
+def shared_gutenberg():
+   global GUTENBERG
+   if GUTENBERG is None:
+      GUTENBERG = Gutenberg()
+   return GUTENBERG
+
 def cmd_search(argv):
-   from collections import OrderedDict
-   ordered_keys = ["key", "author", "title", "language", "subject"]
-   for doc in Gutenberg().search(argv[0]):
-      doc = OrderedDict((k, doc[k]) for k in ordered_keys)
-      print(json.dumps(doc, ensure_ascii=False))
+   ordered_keys = ("key", "author", "title", "language", "subject")
+   # Results are written in batches rather than one line at a time.
+   lines = []
+   for doc in shared_gutenberg().search(argv[0]):
+      # Dicts preserve insertion order.
+      doc = {k: doc[k] for k in ordered_keys}
+      lines.append(JSON_ENCODER.encode(doc) + "\n")
+      if len(lines) == SEARCH_BATCH_SIZE:
+         sys.stdout.write("".join(lines))
+         lines = []
+   sys.stdout.write("".join(lines))
 
 def cmd_text(argv):
-   for text in Gutenberg().text(argv[0]):
-      sys.stdout.write(text)
+   # Ebooks are stored as UTF-8, so, if that's also the encoding of the
+   # standard output, we can write them as is instead of decoding them first.
+   if codecs.lookup(sys.stdout.encoding).name == "utf-8":
+      sys.stdout.flush()
+      out = sys.stdout.buffer
+      for blob in shared_gutenberg().contents(argv[0]):
+         out.writelines(decompress_chunks(blob))
+   else:
+      for chunk in shared_gutenberg().stream(argv[0]):
+         sys.stdout.write(chunk)
+
+# Writes an ebook to a file, unless the file already exists. Returns whether
+# the file was written. Runs in a thread, zlib releases the GIL while
+# decompressing.
+def write_ebook(target, blob):
+   # Creating the file exclusively is atomic, so there is no race between
+   # checking for an existing file and creating it, even when two ebooks map
+   # to the same file.
+   try:
+      f = open(target, "xb")
+   except FileExistsError:
+      return False
+   # Contents are stored as UTF-8, no need to decode them.
+   with f:
+      f.writelines(decompress_chunks(blob))
+   return True
+
+# The future is None if the file was known to exist beforehand.
+def report_ebook(target, future):
+   if future and future.result():
+      print(f"WRITING: {target}")
+   else:
+      print(f"SKIPPING: file already exists: {target}")
 
 def cmd_file(argv):
-   for author, title, blob in Gutenberg().file(argv[0]):
-      normalized_author = slugify(author)[:32]
-      normalized_title = slugify(title)[:48]
-      target = f"{normalized_author}_{normalized_title}.txt"
-      if os.path.exists(target):
-         print(f"SKIPPING: file already exists: {target}")
-      else:
-         with open(target, "w") as f:
-            f.write(zlib.decompress(blob).decode())
-         print(f"WRITING: {target}")
+   # Ebooks are written in parallel, but reported in order. Only a few are
+   # queued at once, since each holds a compressed blob.
+   max_pending = 2 * (os.cpu_count() or 1)
+   pending = deque()
+   # Many ebooks share the same author.
+   author_slugs = {}
+   # When exporting again to the same directory, most files already exist.
+   # Reading the directory once is cheaper than trying to create each file,
+   # and avoids handing their contents to a thread for nothing. Names handed
+   # out are added as we go, so that when several ebooks map to the same file,
+   # the first one in query order is written.
+   existing = {entry.name for entry in os.scandir()}
+   with ThreadPoolExecutor(max_pending) as threads:
+      for author, title, blob in shared_gutenberg().file(argv[0]):
+         normalized_author = author_slugs.get(author)
+         if normalized_author is None:
+            normalized_author = author_slugs[author] = slugify(author)[:32]
+         normalized_title = slugify(title)[:48]
+         target = f"{normalized_author}_{normalized_title}.txt"
+         if target in existing:
+            pending.append((target, None))
+         else:
+            pending.append((target, threads.submit(write_ebook, target, blob)))
+            existing.add(target)
+         if len(pending) >= max_pending:
+            report_ebook(*pending.popleft())
+      for target, future in pending:
+         report_ebook(target, future)
 
 def cmd_download(argv):
-   Gutenberg().download(argv[0])
+   shared_gutenberg().download(argv[0])
 
 def cmd_update(argv):
-   Gutenberg().update()
+   shared_gutenberg().update()
 
 def cmd_forget(argv):
-   Gutenberg().forget(argv[0])
+   shared_gutenberg().forget(argv[0])
 
 def cmd_queries(argv):
-   for q in Gutenberg().queries():
-      print(q)
+   sys.stdout.write("".join(q + "\n" for q in shared_gutenberg().queries()))
 
+# Command name -> (function, number of arguments).
 COMMANDS = {
-   "search": {"func": cmd_search, "argc": 1},
-   "text": {"func": cmd_text, "argc": 1},
-   "file": {"func": cmd_file, "argc": 1},
-   "download": {"func": cmd_download, "argc": 1},
-   "queries": {"func": cmd_queries, "argc": 0},
-   "update": {"func": cmd_update, "argc": 0},
-   "forget": {"func": cmd_forget, "argc": 1},
+   "search": (cmd_search, 1),
+   "text": (cmd_text, 1),
+   "file": (cmd_file, 1),
+   "download": (cmd_download, 1),
+   "queries": (cmd_queries, 0),
+   "update": (cmd_update, 0),
+   "forget": (cmd_forget, 1),
 }
 
 USAGE = """\
@@ -874,13 +1551,19 @@ def usage():
    die()
 
 if __name__ == "__main__":
+   # Exit right away on Ctrl-C instead of waiting for download threads and
+   # worker processes to wind down. The database is not corrupted by this,
+   # at worst the current transaction is lost.
+   signal.signal(signal.SIGINT, lambda *_: os._exit(130))
    argc, argv = len(sys.argv), sys.argv
    if argc < 2:
       usage()
-   cmd = COMMANDS.get(argv[1])
-   if not cmd or argc - 2 != cmd["argc"]:
+   func, nargs = COMMANDS.get(argv[1], (None, None))
+   if not func or argc - 2 != nargs:
       usage()
    try:
-      cmd["func"](argv[2:])
-   except (KeyboardInterrupt, BrokenPipeError):
+      func(argv[2:])
+      if GUTENBERG:
+         GUTENBERG.close()
+   except BrokenPipeError:
       die()